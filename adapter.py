@@ -2,8 +2,13 @@
 import argparse
 import binascii
 import etao
+import mmap
+import os
+import Queue
 import spidev
 import struct
+import sys
+import threading
 from tqdm import tqdm
 import time
 import RPi.GPIO as GPIO
@@ -13,94 +18,184 @@ from card import GCMHeader
 BLOCK_SZ = 0x2000
 SECTOR_SZ = 0x800
 TIMING_LEN = 128
-READ_SZ = 0x200  # - (5 + TIMING_LEN)
+READ_SZ = 0x200  # - (CMD_HDR_LEN + TIMING_LEN)
+
+# command byte followed by the four address bytes
+CMD_HDR_LEN = 5
 WRITE_SZ = 0x80
 
+# contents of a page after its sector has been erased (a buffer, so it
+# compares against buffer views of the image)
+ERASED_PAGE = buffer('\xff' * WRITE_SZ)
+
+# status register bits
+STATUS_READY = 0x01
+STATUS_PROGRAM_ERROR = 0x08
+STATUS_ERASE_ERROR = 0x10
+STATUS_BUSY = 0x80
+
+# card address as sent in command headers
+ADDR_STRUCT = struct.Struct('>BBBB')
+ADDR_WORD = struct.Struct('>I')
+
+# 0x83 0x00 command followed by one byte clocked out for the status
+GET_STATUS_CMD = bytearray('\x83\x00\xff')
+
+# reused by read_page: 0x52 command, address, then 0xff filler clocked
+# out for the timing bytes and the response
+READ_CMD = bytearray('\x52' + '\x00' * (CMD_HDR_LEN - 1) +
+                     '\xff' * (TIMING_LEN + READ_SZ))
+
+# reused by write_page: 0xf2 command, address, then page data
+WRITE_CMD = bytearray('\xf2' + '\x00' * (CMD_HDR_LEN - 1 + WRITE_SZ))
+
+# card ready polling: start short, back off towards the old fixed 3.5ms
+READY_POLL_MIN = 0.1 / 1000.0
+READY_POLL_MAX = 3.5 / 1000.0
+# no hard timeout: giving up after an erase would leave the sector blank,
+# so keep waiting like before and just report it every second
+READY_NOTICE_INTERVAL = 1.0
+
+# delays before each ready re-check after clearing status (~3.8ms in total)
+CLEAR_STATUS_POLLS = (0.1 / 1000.0, 0.2 / 1000.0, 0.5 / 1000.0,
+                      1.0 / 1000.0, 2.0 / 1000.0)
+
 # GPIO pins
 GPIO_INT = 7
 
 
 def addr_from_bytes(addr_bytes):
-    addr_bytes = list(struct.unpack('>BBBB', addr_bytes))
-    result = addr_bytes[0] << 17
-    result += addr_bytes[1] << 9
-    result += (addr_bytes[2] & 3) << 7
-    result += addr_bytes[3] & 0x7F
-    return result
+    addr = ADDR_WORD.unpack(addr_bytes)[0]
+    return (((addr >> 24) << 17) | (((addr >> 16) & 0xFF) << 9) |
+            (((addr >> 8) & 3) << 7) | (addr & 0x7F))
 
 
 def addr_to_bytes(address):
-    packed = [0, 0, 0, 0]
-    packed[0] = (address >> 17) & 0xFF
-    packed[1] = (address >> 9) & 0xFF
-    packed[2] = (address >> 7) & 0x3
-    packed[3] = address & 0x7F
-    return packed
+    return ADDR_STRUCT.pack((address >> 17) & 0xFF,
+                            (address >> 9) & 0xFF,
+                            (address >> 7) & 0x3,
+                            address & 0x7F)
 
 
-def read_page(spi, address, amount=READ_SZ):
-    read_cmd = [0x52]
-    read_cmd.extend(addr_to_bytes(address))
-
-    cmd_len = len(read_cmd)  # (5)
+def read_page(spi, address, amount=READ_SZ, out=None):
+    cmd_len = CMD_HDR_LEN
     out_len = TIMING_LEN
     in_len = amount
 
     if in_len > (READ_SZ):
         raise Exception('max 0x%x bytes per read' % (READ_SZ))
 
-    # time buffer + response size buffer
-    read_cmd.extend([0xFF for x in range(out_len + in_len)])
+    # only the address changes between reads, patch it in place
+    READ_CMD[1:cmd_len] = addr_to_bytes(address)
 
-    response = spi.xfer2(read_cmd)
+    # time buffer + response size buffer
+    if in_len == READ_SZ:
+        response = spi.xfer2(READ_CMD)
+    else:
+        response = spi.xfer2(READ_CMD[:cmd_len + out_len + in_len])
 
-    result = ''.join([chr(x) for x in response])
+    # fill the caller's buffer instead of building a new string
+    if out is not None:
+        out[:] = bytearray(response[cmd_len + out_len:])
+        return out
 
-    return result[cmd_len + out_len:]
+    return str(bytearray(response[cmd_len + out_len:]))
 
 
-def write_page(spi, address, data):
+def wait_ready(spi):
+    """Poll until the card is ready and no erase/program is in progress,
+    returning the last status read."""
     ready = False
 
-    GPIO.output(GPIO_INT, GPIO.LOW)
-
     status = get_status(spi)
-    if status & 1:
+    if status & STATUS_READY and not status & STATUS_BUSY:
         ready = True
 
+    delay = READY_POLL_MIN
+    next_notice = time.time() + READY_NOTICE_INTERVAL
     while not ready:
-        # wait 3.5ms
-        time.sleep(3.5 / 1000.0)
+        if time.time() > next_notice:
+            print 'waiting for card ready... (0x%02x)' % (status)
+            next_notice += READY_NOTICE_INTERVAL
+
+        time.sleep(delay)
+        delay = min(delay * 1.5, READY_POLL_MAX)
 
         status = get_status(spi)
 
-        if status & 1 and not status & 0x80:
+        if status & STATUS_READY and not status & STATUS_BUSY:
             ready = True
-        else:
-            print 'waiting for card ready...'
 
-    clear_status(spi)
+    return status
 
-    GPIO.output(GPIO_INT, GPIO.HIGH)
 
-    write_cmd = [0xf2]
-    write_cmd.extend(addr_to_bytes(address))
+def write_page(spi, address, data):
+    """Program one page. Status is not cleared here: callers clear it once
+    before erasing a sector and check the error bits after its pages."""
+    GPIO.output(GPIO_INT, GPIO.LOW)
+
+    # the previous page may still be programming, so this doubles as
+    # the wait for it instead of a fixed sleep after each write
+    wait_ready(spi)
+
+    GPIO.output(GPIO_INT, GPIO.HIGH)
 
     if len(data) > WRITE_SZ:
         raise Exception('max write size is 0x%02x' % (WRITE_SZ))
 
-    write_cmd.extend([ord(d) for d in data])
-
-    spi.xfer2(write_cmd)
+    # fill the command in place rather than building it per page
+    cmd_len = CMD_HDR_LEN + len(data)
+    WRITE_CMD[1:CMD_HDR_LEN] = addr_to_bytes(address)
+    WRITE_CMD[CMD_HDR_LEN:cmd_len] = data
 
-    # wait 3.5ms
-    time.sleep(3.5 / 1000.0)
+    # write-only transfer straight from the buffer, no per-byte list
+    spi.writebytes2(memoryview(WRITE_CMD)[:cmd_len])
 
     return None
 
 
+def drain_to_file(output, full_pages, free_pages, errors):
+    """Save filled dump buffers to the output file until None is queued,
+    handing each buffer back to the reader once it has been saved.
+
+    If saving fails the exception is stored in errors and the buffer is
+    still handed back, so the reader wakes up and can re-raise it."""
+    for page, amount in iter(full_pages.get, None):
+        try:
+            output.write(memoryview(page)[:amount])
+        except Exception:
+            errors.append(sys.exc_info())
+            free_pages.put(page)
+            return
+        free_pages.put(page)
+
+
+def raise_output_error(errors):
+    """Re-raise the first error stored by drain_to_file, if any."""
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+
+def map_image(path):
+    """Map a card image file read-only instead of reading it into memory."""
+    with open(path, 'rb') as image:
+        # an empty file can't be mapped, and can't be a card image either
+        if os.fstat(image.fileno()).st_size == 0:
+            raise Exception('image size mismatch')
+        return mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_dirty_blocks(original, updated, block_size):
+    """Return the indices of the blocks that differ between two images
+    of the same size."""
+    return [i for i, pos in enumerate(xrange(0, len(updated), block_size))
+            if buffer(original, pos, block_size) !=
+            buffer(updated, pos, block_size)]
+
+
 def erase_sector(spi, address):
-    erase_cmd = [0xf1]
+    erase_cmd = bytearray('\xf1')
 
     # upper two bytes of address indicate sector
     up_addr = addr_to_bytes(address)[:2]
@@ -136,22 +231,25 @@ def erase_sector(spi, address):
 
 
 def clear_status(spi):
+    """Clear the card status, returning True once the card reports ready
+    or False if it still isn't after the last poll."""
     spi.xfer2([0x89])
-    time.sleep(3.5 / 1000.0)
-
 
-def get_status(spi):
-    cmd = [0x83, 0x00]
+    # usually ready straight away, so poll rather than sleeping 3.5ms
+    if get_status(spi) & STATUS_READY:
+        return True
 
-    cmd_len = len(cmd)
-    out_len = cmd_len
-    in_len = 1
+    for delay in CLEAR_STATUS_POLLS:
+        time.sleep(delay)
+        if get_status(spi) & STATUS_READY:
+            return True
 
-    cmd.extend([0xFF for x in range(in_len)])
+    return False
 
-    response = spi.xfer2(cmd)
 
-    return response[out_len:][0]
+def get_status(spi):
+    # status byte comes back after the two command bytes
+    return spi.xfer2(GET_STATUS_CMD)[2]
 
 
 def set_interrupt(spi, enable=True):
@@ -180,6 +278,8 @@ def main():
     parser.add_argument('-r', '--read', type=str)
     parser.add_argument('-w', '--write', type=str, nargs=2,
                         help='original_file updated_file - writes diffs')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every erase and page write')
     args = parser.parse_args()
 
     spi = spidev.SpiDev()
@@ -193,9 +293,19 @@ def main():
     GPIO.setup(GPIO_INT, GPIO.OUT)
     GPIO.output(GPIO_INT, GPIO.LOW)
 
+    # release the SPI device and GPIO pins even if a dump or write fails
+    try:
+        run_card(spi, args)
+    finally:
+        spi.close()
+        GPIO.cleanup()
+
+
+def run_card(spi, args):
+    """Bring the card up, then dump or write it as requested by args."""
     # opening sequence?
     opener_response = spi.xfer2([0x00, 0x00, 0xFF, 0xFF, 0x00, 0x00], 800000)
-    opener_response = ''.join([chr(x) for x in opener_response])
+    opener_response = str(bytearray(opener_response))
     print 'opening sequence:', binascii.hexlify(opener_response)
 
     GPIO.output(GPIO_INT, GPIO.HIGH)
@@ -209,7 +319,7 @@ def main():
         print 'getting status: 0x%02x' % (status)
         print etao.get_bits(status)
 
-        if status & 1:
+        if status & STATUS_READY:
             cleared_status = True
 
     print 'setting interrupt...'
@@ -234,7 +344,6 @@ def main():
 
     if header.sizeMb > 128:
         print 'ERROR: maximum size is 128 Mb'
-        GPIO.cleanup()
         return
 
     # total size of card in bytes
@@ -242,16 +351,30 @@ def main():
     total_size = header.sizeMb * 0x10 * BLOCK_SZ
 
     if args.read is not None:
-        output = open(args.read, 'wb')
-
-        content = ''
+        output = open(args.read, 'wb', 1 << 20)
+
+        # double buffered: the next page is read over SPI while the
+        # previous one is written out by the writer thread
+        full_pages = Queue.Queue()
+        free_pages = Queue.Queue()
+        output_errors = []
+        for _ in range(2):
+            free_pages.put(bytearray(READ_SZ))
+
+        writer = threading.Thread(target=drain_to_file,
+                                  args=(output, full_pages, free_pages,
+                                        output_errors))
+        writer.daemon = True
+        writer.start()
 
         num_reads = total_size / READ_SZ
         if num_reads * READ_SZ < total_size:
             num_reads += 1
         # print '%u / %u = %u' % (total_size, READ_SZ, total_size / READ_SZ)
         # print 'total reads: %u' % (num_reads)
-        for i in tqdm(range(num_reads)):
+        # only check the clock / redraw the bar every 64 pages
+        for i in tqdm(range(num_reads), unit='pg', miniters=64,
+                      mininterval=0.25):
             start_addr = i * READ_SZ
             if start_addr + READ_SZ > total_size:
                 read_amount = (total_size - start_addr) % READ_SZ
@@ -259,57 +382,74 @@ def main():
             else:
                 read_amount = READ_SZ
             # print 'read #%u @ 0x%08x' % (i, start_addr)
-            get_page = read_page(spi, start_addr, amount=read_amount)
-            # print binascii.hexlify(get_page)
-            # print 'got %u bytes' % (len(get_page))
-            content += get_page
-            # print 'content length %u' % (len(content))
-
-        output.write(content)
+            page = free_pages.get()
+            raise_output_error(output_errors)
+            read_page(spi, start_addr, amount=read_amount,
+                      out=memoryview(page)[:read_amount])
+            full_pages.put((page, read_amount))
+
+        full_pages.put(None)
+        writer.join()
+        raise_output_error(output_errors)
         output.close()
     elif args.write is not None:
-        original = open(args.write[0], 'rb')
-        inputf = open(args.write[1], 'rb')
-        original_content = original.read()
-        new_content = inputf.read()
-        original.close()
-        inputf.close()
-
-        if len(original_content) != len(new_content) or len(new_content) != total_size:
-            raise Exception('image size mismatch')
-
-        diff_count = 0
-
-        for i in tqdm(range(total_size / BLOCK_SZ)):
-            pos = i * BLOCK_SZ
-            original_sector = original_content[pos:pos + BLOCK_SZ]
-            new_sector = new_content[pos:pos + BLOCK_SZ]
-
-            #print 'writing block %u of %u' % (i + 1, total_size / BLOCK_SZ)
-
-            if original_sector != new_sector:
-                diff_count += 1
-
-                #print 'erase sector @ 0x%04x' % (pos)
-                erase_sector(spi, pos)
-
-                for j in range(BLOCK_SZ / WRITE_SZ):
-                    slice_pos = pos + (j * WRITE_SZ)
-                    #print 'write slice @ 0x%08x' % (slice_pos)
-                    new_slice = new_sector[j * WRITE_SZ:(j + 1) * WRITE_SZ]
-                    write_page(spi, slice_pos, new_slice)
-
-            time.sleep(4.0 / 1000.0)
-            GPIO.output(GPIO_INT, GPIO.LOW)
-            get_status(spi)
-            clear_status(spi)
-            GPIO.output(GPIO_INT, GPIO.HIGH)
-            time.sleep(14.0 / 1000.0)
-
-        print 'updated %u blocks' % (diff_count)
+        original_content = map_image(args.write[0])
+        new_content = map_image(args.write[1])
+        try:
+            write_image(spi, args, total_size, original_content, new_content)
+        finally:
+            original_content.close()
+            new_content.close()
+
+
+def write_image(spi, args, total_size, original_content, new_content):
+    """Erase and rewrite the blocks that differ between two card images."""
+    if len(original_content) != len(new_content) or len(new_content) != total_size:
+        raise Exception('image size mismatch')
+
+    # unchanged blocks are skipped entirely, including the status
+    # epilogue below
+    dirty_blocks = find_dirty_blocks(original_content, new_content, BLOCK_SZ)
+    diff_count = len(dirty_blocks)
+
+    for i in tqdm(dirty_blocks):
+        pos = i * BLOCK_SZ
+
+        if args.verbose:
+            tqdm.write('writing block %u of %u' %
+                       (i + 1, total_size / BLOCK_SZ))
+
+        if not clear_status(spi):
+            raise Exception('card not ready to erase block %u' % (i))
+
+        if args.verbose:
+            tqdm.write('erase sector @ 0x%04x' % (pos))
+        erase_sector(spi, pos)
+
+        for j in range(BLOCK_SZ / WRITE_SZ):
+            slice_pos = pos + (j * WRITE_SZ)
+            # zero-copy view, write_page copies it into WRITE_CMD
+            new_slice = buffer(new_content, slice_pos, WRITE_SZ)
+            # erased pages already read back as 0xFF
+            if new_slice == ERASED_PAGE:
+                continue
+            if args.verbose:
+                tqdm.write('write slice @ 0x%08x' % (slice_pos))
+            write_page(spi, slice_pos, new_slice)
+
+        time.sleep(4.0 / 1000.0)
+        GPIO.output(GPIO_INT, GPIO.LOW)
+        # the erase (or last page program) may still be running, and the
+        # error bits are only meaningful once it has finished
+        status = wait_ready(spi)
+        if status & (STATUS_ERASE_ERROR | STATUS_PROGRAM_ERROR):
+            raise Exception('failed to write block %u (status 0x%02x)' %
+                            (i, status))
+        clear_status(spi)
+        GPIO.output(GPIO_INT, GPIO.HIGH)
+        time.sleep(14.0 / 1000.0)
 
-    spi.close()
-    GPIO.cleanup()
+    print 'updated %u blocks' % (diff_count)
 
 
 if __name__ == '__main__':
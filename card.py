@@ -1,16 +1,15 @@
 import binascii
 import struct
 
+HDR_STRUCT = struct.Struct('>12sQIIIHHH')
+
 class GCMHeader:
 
     def __init__(self):
         pass
 
     def load_bytes(self, buf):
-        hdr_format = '>12sQIIIHHH'
-        hdr_size = struct.calcsize(hdr_format)
-
-        serial, time, bias, lang, unk1, deviceId, sizeMb, encoding = struct.unpack(hdr_format, buf[:hdr_size])
+        serial, time, bias, lang, unk1, deviceId, sizeMb, encoding = HDR_STRUCT.unpack_from(buf)
 
         self.serial = serial
         self.time = time
@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 import argparse
 import binascii
+import re
 
 
-def get_data(line, field):
-    mosi_pos = line.find(field)
-    if mosi_pos != -1:
-        hex_pos = line.find('0x', mosi_pos)
-        if hex_pos != -1:
-            data = binascii.unhexlify(line[hex_pos+2:hex_pos+4])
-            return data
+def field_pattern(field):
+    """Match the first hex byte following a field name on a line."""
+    return re.compile(field + r'.*?0x([0-9a-fA-F]{2})')
+
+
+MOSI_PATTERN = field_pattern('MOSI')
+MISO_PATTERN = field_pattern('MISO')
+
+
+def get_data(line, pattern):
+    match = pattern.search(line)
+    if match is not None:
+        return match.group(1)
 
     return None
 
@@ -20,27 +27,30 @@ def main():
     parser.add_argument('output', type=str)
     args = parser.parse_args()
 
-    with open(args.csv, 'r') as csv_file:
-        csv_content = [x.rstrip('\r\n') for x in csv_file.readlines()]
-        mosi_file = open(args.output + '_mosi', 'wb')
-        miso_file = open(args.output + '_miso', 'wb')
+    # collect hex digits and decode each stream once at the end
+    mosi_hex = []
+    miso_hex = []
 
-        for line in csv_content:
-            mosi = get_data(line, 'MOSI')
-            miso = get_data(line, 'MISO')
+    with open(args.csv, 'r') as csv_file:
+        for line in csv_file:
+            mosi = get_data(line, MOSI_PATTERN)
+            miso = get_data(line, MISO_PATTERN)
 
             if mosi is not None:
-                mosi_file.write(mosi)
+                mosi_hex.append(mosi)
             else:
-                print 'error getting mosi'
+                print('error getting mosi')
 
             if miso is not None:
-                miso_file.write(miso)
+                miso_hex.append(miso)
             else:
-                print 'error getting miso'
+                print('error getting miso')
+
+    with open(args.output + '_mosi', 'wb') as mosi_file:
+        mosi_file.write(binascii.unhexlify(''.join(mosi_hex)))
 
-        mosi_file.close()
-        miso_file.close()
+    with open(args.output + '_miso', 'wb') as miso_file:
+        miso_file.write(binascii.unhexlify(''.join(miso_hex)))
 
 
 if __name__ == '__main__':
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 import argparse
 import etao
+import os
+import re
 import struct
+import sys
 from binascii import hexlify
 
 
@@ -9,11 +12,7 @@ def block_count(data_size, block_size):
     """The number of blocks of given size required to
     hold the data."""
 
-    blocks = 0
-    while (block_size * blocks) < data_size:
-        blocks += 1
-
-    return blocks
+    return (data_size + block_size - 1) // block_size
 
 
 def block_align(data_size, block_size):
@@ -52,15 +51,23 @@ COMMANDS = [
     WRITE_BLOCK_CMD
 ]
 
-COMMAND_TABLE = {}
+# indexed by the command's first byte, None for unknown bytes
+COMMAND_TABLE = [None] * 256
 for command in COMMANDS:
-    lookup_byte = command.code[:1]
+    lookup_byte = ord(command.code[:1])
     COMMAND_TABLE[lookup_byte] = command
 
 
+ADDR_WORD = struct.Struct('>I')
+
+# bus idle between commands
+IDLE_RUN = re.compile(r'[\x00\xff]+')
+
+
 def unpack_addr(request):
-    y1, y2, y3, y4 = struct.unpack('>BBBB', request)
-    offset = (y1 << 17) + (y2 << 9) + ((y3 & 3) << 7) + (y4 & 0x7F)
+    addr = ADDR_WORD.unpack(request)[0]
+    offset = (((addr >> 24) << 17) | (((addr >> 16) & 0xFF) << 9) |
+              (((addr >> 8) & 3) << 7) | (addr & 0x7F))
     return offset
 
 
@@ -70,6 +77,9 @@ def main():
     parser.add_argument('mosi', type=str)
     args = parser.parse_args()
 
+    # the decode is mostly small prints, so batch them into large writes
+    sys.stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1 << 20)
+
     miso_stream = open(args.miso, 'rb').read()
     mosi_stream = open(args.mosi, 'rb').read()
 
@@ -81,20 +91,20 @@ def main():
             break
 
         byte = mosi_stream[i]
+        cmd = COMMAND_TABLE[ord(byte)]
 
-        if byte not in COMMAND_TABLE:
+        if cmd is None:
             if byte != '\x00' and byte != '\xff':
                 print 'position: 0x%04x' % (i)
                 print 'MOSI: unrecognized 0x%x' % (ord(byte))
+                i += 1
             else:
-                print '.',
-            i += 1
+                # jump over the whole idle run instead of byte by byte
+                i = IDLE_RUN.match(mosi_stream, i).end()
             continue
 
         print 'position: 0x%04x' % (i)
 
-        cmd = COMMAND_TABLE[byte]
-
         print 'MOSI: %s' % (cmd.desc)
 
         outlen = cmd.outlen
@@ -149,6 +159,8 @@ def main():
 
             i += outlen
 
+    sys.stdout.flush()
+
 
 if __name__ == '__main__':
     main()